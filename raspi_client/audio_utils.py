@@ -22,6 +22,8 @@ from config import (
     SAMPLE_RATE,
     CHANNELS,
     FORMAT,
+    PERIOD_SIZE,
+    BUFFER_SIZE,
     DEFAULT_DURATION,
     RECORDINGS_DIR,
 )
@@ -62,6 +64,8 @@ def _run_arecord(output_path: str, duration: int) -> None:
         "-r", str(SAMPLE_RATE),   # sample rate
         "-c", str(CHANNELS),      # channels
         "-d", str(duration),      # duration in seconds
+        f"--period-size={PERIOD_SIZE}",   # frames per ALSA period
+        f"--buffer-size={BUFFER_SIZE}",   # frames in the ALSA ring buffer
         output_path
     ]
 
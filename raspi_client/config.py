@@ -27,6 +27,11 @@ SAMPLE_RATE = 16000        # Hz
 CHANNELS = 1               # mono
 FORMAT = "S16_LE"          # 16-bit PCM
 
+# ALSA buffering (in frames): one period per MFCC hop (10 ms at 16 kHz),
+# buffer holds 20 periods (200 ms)
+PERIOD_SIZE = 160
+BUFFER_SIZE = 3200
+
 # Default recording duration (seconds) for each sample
 DEFAULT_DURATION = 7
 
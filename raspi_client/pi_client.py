@@ -18,7 +18,10 @@ Authenticate (no username needed, server will decide who it matches)
 import argparse
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
+from requests.adapters import HTTPAdapter
 
 from audio_utils import (
     check_arecord_available,
@@ -28,6 +31,11 @@ from audio_utils import (
 
 from config import SERVER_URL, ENROLL_ENDPOINT, AUTH_ENDPOINT
 
+# Shared HTTP session so consecutive uploads reuse the keep-alive connection
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
 def build_url(server_url: str, endpoint: str) -> str:
     """Safely join base server URL with endpoint path."""
     return server_url.rstrip("/") + endpoint
@@ -42,11 +50,12 @@ def send_enrollment_sample(server_url: str, username: str, sample_idx: int, wav_
 
     print(f"[pi_client] Uploading enrollment sample {sample_idx} for '{username}' to {url}")
 
-    files = {"audio": open(wav_path, "rb")}
     data = {"username": username, "sample_idx": sample_idx}
 
     try:
-        resp = requests.post(url, files=files, data=data, timeout=10)
+        with open(wav_path, "rb") as fh:
+            files = {"audio": (os.path.basename(wav_path), fh, "audio/wav")}
+            resp = SESSION.post(url, files=files, data=data, timeout=10)
         resp.raise_for_status()
         print(f"[pi_client] Server response: {resp.status_code} {resp.text}")
     except requests.RequestException as e:
@@ -62,10 +71,10 @@ def send_auth_sample(server_url: str, wav_path: str) -> None:
 
     print(f"[pi_client] Uploading auth sample to {url}")
 
-    files = {"audio": open(wav_path, "rb")}
-
     try:
-        resp = requests.post(url, files=files, timeout=10)
+        with open(wav_path, "rb") as fh:
+            files = {"audio": (os.path.basename(wav_path), fh, "audio/wav")}
+            resp = SESSION.post(url, files=files, timeout=10)
         resp.raise_for_status()
         try:
             data = resp.json()
@@ -84,12 +93,26 @@ def handle_enroll(args: argparse.Namespace) -> None:
     print(f"[pi_client] Enrolling user '{username}' with {num_samples} sample(s)")
     print(f"[pi_client] Server URL: {server_url}")
 
-    for sample_idx in range(1, num_samples + 1):
-        input(f"\nPress Enter to record sample {sample_idx}/{num_samples} for '{username}'...")
-        wav_path = record_enrollment_sample(username=username, sample_idx=sample_idx)
-
-        # Send sample to the server
-        send_enrollment_sample(server_url, username, sample_idx, wav_path)
+    # Uploads run in the background while the next sample is being recorded.
+    # A single worker keeps them in order so the server never updates the
+    # same user from two requests at once.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        futures = []
+        for sample_idx in range(1, num_samples + 1):
+            input(f"\nPress Enter to record sample {sample_idx}/{num_samples} for '{username}'...")
+            wav_path = record_enrollment_sample(username=username, sample_idx=sample_idx)
+
+            # Send sample to the server
+            futures.append(
+                executor.submit(send_enrollment_sample, server_url, username, sample_idx, wav_path)
+            )
+
+        # Wait for the remaining uploads and surface any unexpected errors
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"[pi_client] ERROR: Enrollment upload failed: {e}")
 
     print(f"\n[pi_client] Enrollment process finished for '{username}'. "
           f"Check the Flask admin UI for updated status.")
@@ -12,8 +12,19 @@ Single web page (dashboard.html) will handle:
 
 """
 
+import atexit
 import os
 import datetime
+import hashlib
+import hmac
+import logging
+import logging.handlers
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
 from flask import (
     Flask,
     request,
@@ -32,8 +43,8 @@ from config import (
     ADMIN_PASSWORD,
     SECRET_KEY,
     DISTANCE_THRESHOLD,
+    LOG_LEVEL,
     DATA_DIR,
-    PORT,
     AUDIO_DIR,
 )
 
@@ -48,6 +59,29 @@ AUDIO_DIR = os.path.join(DATA_DIR, "audio_samples")
 
 os.makedirs(AUDIO_DIR, exist_ok=True)
 
+# Logging: records are queued by request threads and written by a listener thread
+logger = logging.getLogger("voice_vault")
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("[%(levelname)s] %(name)s: %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# Only the digest of the admin password is compared at login
+_ADMIN_PASSWORD_HASH = hashlib.sha256(ADMIN_PASSWORD.encode()).digest()
+
+# Background writer for archived audio samples
+audio_writer = ThreadPoolExecutor(max_workers=2, thread_name_prefix="audio-writer")
+
+# Features of recent enrollment uploads, keyed by a digest of the audio bytes
+FEATURE_CACHE_SIZE = 64
+_feature_cache: "OrderedDict[str, Any]" = OrderedDict()
+_feature_cache_lock = threading.Lock()
+
 
 # Helpers
 
@@ -55,6 +89,42 @@ def get_timestamp_str() -> str:
     return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
+def _report_write_error(future: Future) -> None:
+    error = future.exception()
+    if error is not None:
+        logger.error("Failed to archive audio file: %s", error)
+
+
+def save_audio(filepath: str, raw: bytes) -> None:
+    """
+    Archive an uploaded WAV in the background; the file is only kept for
+    auditing, so the response doesn't wait on the disk write.
+    """
+    future = audio_writer.submit(storage.write_file_atomic, filepath, raw)
+    future.add_done_callback(_report_write_error)
+
+
+def extract_features_cached(raw: bytes) -> Any:
+    """
+    Extract features from uploaded audio, reusing the result when the exact
+    same bytes were seen recently (e.g. the Pi retrying an enrollment upload).
+    """
+    key = hashlib.blake2b(raw, digest_size=16).hexdigest()
+    with _feature_cache_lock:
+        features = _feature_cache.get(key)
+        if features is not None:
+            _feature_cache.move_to_end(key)
+            return features
+
+    features = ml_utils.extract_features_from_bytes(raw)
+
+    with _feature_cache_lock:
+        _feature_cache[key] = features
+        if len(_feature_cache) > FEATURE_CACHE_SIZE:
+            _feature_cache.popitem(last=False)
+    return features
+
+
 # Dashboard User Interface
 @app.route("/", methods=["GET", "POST"])
 def dashboard():
@@ -67,7 +137,8 @@ def dashboard():
         # Admin login
         if action == "admin_login":
             password = request.form.get("password", "")
-            if password == ADMIN_PASSWORD:
+            password_hash = hashlib.sha256(password.encode()).digest()
+            if hmac.compare_digest(password_hash, _ADMIN_PASSWORD_HASH):
                 session["is_admin"] = True
                 is_admin = True
                 flash("Admin login successful.", "success")
@@ -100,16 +171,19 @@ def dashboard():
     recognized_user = last_auth.get("user") if last_auth else None
     distance = last_auth.get("distance") if last_auth else None
 
-    # Users list
-    users_dict = storage.load_users()
-    users = list(users_dict.keys())
+    # Users list (only shown to the admin)
+    users = []
+    if is_admin:
+        users = list(storage.load_users().keys())
 
-    # Secrets
-    secrets = storage.load_secrets()
-    global_secret = secrets.get("global_message", "No global secret set.")
+    # Secrets (only shown while the vault is unlocked)
+    global_secret = ""
     user_secret = ""
-    if recognized_user:
-        user_secret = secrets.get("user_notes", {}).get(recognized_user, "No user-specific secret.")
+    if is_unlocked:
+        secrets = storage.load_secrets()
+        global_secret = secrets.get("global_message", "No global secret set.")
+        if recognized_user:
+            user_secret = secrets.get("user_notes", {}).get(recognized_user, "No user-specific secret.")
 
     # Script they must read for enrollment
     enrollment_script = "This is a test enrollment. Please read the following script: 'My voice is my key, verify me securely.'"
@@ -137,85 +211,65 @@ def dashboard():
 
 @app.route("/api/audio/enroll", methods=["POST"])
 def api_audio_enroll():
-    print("[ENROLL] ===== Enrollment request received =====")
-    
+    logger.debug("===== Enrollment request received =====")
+
     audio_file = request.files.get("audio")
     username = request.form.get("username", "").strip()
     sample_idx = request.form.get("sample_idx", None)
-    
-    print(f"[ENROLL] Username: {username}")
-    print(f"[ENROLL] Sample index: {sample_idx}")
-    print(f"[ENROLL] Audio file received: {audio_file is not None}")
+
+    logger.debug("Username: %s", username)
+    logger.debug("Sample index: %s", sample_idx)
+    logger.debug("Audio file received: %s", audio_file is not None)
 
     if not audio_file or not username:
-        print("[ENROLL] ERROR: Missing audio file or username")
+        logger.warning("Missing audio file or username")
         return jsonify({"status": "error", "message": "Missing audio file or username"}), 400
 
     # Verify user exists (must be created in dashboard first)
-    print("[ENROLL] Checking if user exists...")
     users = storage.load_users()
-    print(f"[ENROLL] Loaded users: {list(users.keys())}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Loaded users: %s", list(users.keys()))
     if username not in users:
-        print(f"[ENROLL] ERROR: User '{username}' not found in users list")
+        logger.warning("User '%s' not found in users list", username)
         return jsonify({
             "status": "error", 
             "message": f"Username '{username}' is not verified. Please create the user in the admin dashboard first."
         }), 400
-    print(f"[ENROLL] User '{username}' verified")
+    logger.debug("User '%s' verified", username)
+
+    # Read the upload once; features are extracted from memory, not from disk
+    raw = audio_file.read()
+    logger.debug("Audio size: %d bytes", len(raw))
+
+    # Extract features
+    try:
+        features = extract_features_cached(raw)
+        logger.debug("Features extracted, shape: %s", getattr(features, "shape", None))
+    except Exception as e:
+        logger.exception("Feature extraction failed")
+        return jsonify({"status": "error", "message": f"Feature extraction failed: {str(e)}"}), 500
 
     # Save audio file
-    print("[ENROLL] Saving audio file...")
     try:
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"{username}_enroll_{sample_idx or 'x'}_{timestamp}.wav"
         filepath = os.path.join(AUDIO_DIR, filename)
-        print(f"[ENROLL] Saving to: {filepath}")
-        audio_file.save(filepath)
-        print(f"[ENROLL] Audio file saved successfully")
-        print(f"[ENROLL] File exists: {os.path.exists(filepath)}")
-        print(f"[ENROLL] File size: {os.path.getsize(filepath) if os.path.exists(filepath) else 'N/A'} bytes")
+        save_audio(filepath, raw)
+        logger.debug("Audio file queued for saving to %s", filepath)
     except Exception as e:
-        print(f"[ENROLL] ERROR: Failed to save audio file: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Failed to save audio file")
         return jsonify({"status": "error", "message": f"Failed to save audio file: {e}"}), 500
 
-    # Extract features
-    print("[ENROLL] Extracting features from audio file...")
-    try:
-        features = ml_utils.extract_features(filepath)
-        print(f"[ENROLL] Features extracted successfully")
-        print(f"[ENROLL] Feature shape: {features.shape if hasattr(features, 'shape') else type(features)}")
-        print(f"[ENROLL] Feature type: {type(features)}")
-    except Exception as e:
-        print(f"[ENROLL] ERROR: Feature extraction failed: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({"status": "error", "message": f"Feature extraction failed: {str(e)}"}), 500
-
-    # Register sample in storage
-    print("[ENROLL] Registering sample in storage...")
+    # Register sample in storage (also updates the user's voiceprint)
     try:
         storage.register_sample(username, filepath, features)
-        print(f"[ENROLL] Sample registered successfully")
+        ml_utils.invalidate_vp_cache()
+        logger.debug("Sample registered and voiceprint updated")
     except Exception as e:
-        print(f"[ENROLL] ERROR: Failed to register sample: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Failed to register sample")
         return jsonify({"status": "error", "message": f"Failed to register sample: {str(e)}"}), 500
 
-    # Recompute/update voiceprint for this user
-    print("[ENROLL] Recomputing voiceprint...")
-    try:
-        storage.recompute_voiceprint(username)
-        print(f"[ENROLL] Voiceprint recomputed successfully")
-    except Exception as e:
-        print(f"[ENROLL] ERROR: Failed to recompute voiceprint: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({"status": "error", "message": f"Failed to recompute voiceprint: {str(e)}"}), 500
-
-    print(f"[ENROLL] ===== Enrollment completed successfully for '{username}' =====")
+    logger.info("Enrollment sample %s stored for '%s'", sample_idx, username)
     return jsonify({"status": "ok", "message": "Enrollment sample received"}), 200
 
 
@@ -226,25 +280,26 @@ def api_audio_authenticate():
     if not audio_file:
         return jsonify({"success": False, "error": "Missing audio file"}), 400
 
+    # Extract features straight from the uploaded data
+    raw = audio_file.read()
+    try:
+        features = ml_utils.extract_features_from_bytes(raw)
+    except Exception as e:
+        return jsonify({"success": False, "error": f"Feature extraction failed: {e}"}), 500
+
     # Save audio file
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     filename = f"auth_{timestamp}.wav"
     filepath = os.path.join(AUDIO_DIR, filename)
-    audio_file.save(filepath)
-
-    # Extract features
-    try:
-        features = ml_utils.extract_features(filepath)
-    except Exception as e:
-        return jsonify({"success": False, "error": f"Feature extraction failed: {e}"}), 500
+    save_audio(filepath, raw)
 
-    # Load voiceprints
-    voiceprints = storage.load_voiceprints() 
-    if not voiceprints:
+    # Load voiceprints (cached until the voiceprints file changes)
+    users, vp_matrix = ml_utils.get_voiceprint_matrix()
+    if not users:
         return jsonify({"success": False, "error": "No enrolled users"}), 400
 
     # Predict speaker using ML
-    best_user, distance = ml_utils.predict_speaker(voiceprints, features)
+    best_user, distance = ml_utils.predict_speaker_fast(users, vp_matrix, features)
 
     # Convert numpy types to native Python types for JSON serialization
     if distance is not None:
@@ -280,5 +335,14 @@ def api_audio_authenticate():
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=PORT, debug=True)
+    # Serve with gunicorn (settings in gunicorn.conf.py) instead of the Flask dev server
+    os.execvp(
+        "gunicorn",
+        [
+            "gunicorn",
+            "--config", os.path.join(BASE_DIR, "gunicorn.conf.py"),
+            "--chdir", BASE_DIR,
+            "app:app",
+        ],
+    )
 
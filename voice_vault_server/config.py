@@ -14,6 +14,9 @@ SECRET_KEY = "6112"
 # Server configuration.
 PORT = int(os.getenv("PORT", 5001)) 
 
+# Log level for the "voice_vault" logger (e.g. DEBUG for enrollment diagnostics).
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
 # Threshold on distance between sample feature vector and stored voiceprint.
 DISTANCE_THRESHOLD = 0.01
 
@@ -21,18 +24,23 @@ DISTANCE_THRESHOLD = 0.01
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "data")
 AUDIO_DIR = os.path.join(DATA_DIR, "audio_samples")
+FEATURES_DIR = os.path.join(DATA_DIR, "features")
 SECRETS_DIR = os.path.join(BASE_DIR, "secrets")
 
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(AUDIO_DIR, exist_ok=True)
+os.makedirs(FEATURES_DIR, exist_ok=True)
 os.makedirs(SECRETS_DIR, exist_ok=True)
 
 # Paths for JSON files (used by storage.py)
 USERS_JSON = os.path.join(DATA_DIR, "users.json")
-VOICEPRINTS_JSON = os.path.join(DATA_DIR, "voiceprints.json")
+VOICEPRINTS_NPZ = os.path.join(DATA_DIR, "voiceprints.npz")
+VOICEPRINTS_JSON = os.path.join(DATA_DIR, "voiceprints.json")  # legacy format, read-only
 LAST_AUTH_JSON = os.path.join(DATA_DIR, "last_auth.json")
-ATTEMPTS_JSON = os.path.join(DATA_DIR, "attempts.json")
+ATTEMPTS_LOG = os.path.join(DATA_DIR, "attempts.jsonl")
+ATTEMPTS_JSON = os.path.join(DATA_DIR, "attempts.json")  # legacy format, read-only
 SECRETS_JSON = os.path.join(SECRETS_DIR, "secrets.json")
+STORAGE_LOCK = os.path.join(DATA_DIR, "storage.lock")  # held during storage updates
 
 
 # ML extraction parameters
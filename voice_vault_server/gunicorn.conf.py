@@ -0,0 +1,34 @@
+"""
+gunicorn.conf.py
+
+Gunicorn settings for serving the Voice Vault backend.
+
+Start from voice_vault_server/ with:
+    gunicorn app:app
+"""
+
+import os
+import sys
+
+# Same port as config.PORT
+bind = f"0.0.0.0:{int(os.getenv('PORT', 5001))}"
+
+# Each worker keeps its own cached voiceprint matrix; storage updates
+# are serialized across workers by storage's file lock
+workers = 4
+worker_class = "gthread"
+threads = 2
+
+# Keep Pi connections open between enrollment uploads
+keepalive = 30
+
+
+def on_starting(server):
+    """
+    Runs once in the master before any worker forks: older users.json files
+    embed every sample's features, so move them out to the .npy files.
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import storage
+
+    storage.migrate_legacy_users()
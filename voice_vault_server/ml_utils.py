@@ -6,48 +6,120 @@ Features:
 -Load WAV audio file
 -Extract MFCC-based speaker features
 -Predict speaker using cosine distance to enrolled voiceprints
+-Cache the stacked voiceprint matrix between authentication requests
 """
 
+import io
 import os
-from typing import Dict, Tuple, Optional
+import threading
+from typing import Any, BinaryIO, Dict, List, Tuple, Optional, Union
 
 import numpy as np
 import librosa
+import scipy.fft
+import scipy.signal
+import soundfile as sf
 
-from config import SAMPLE_RATE, N_MFCC, N_FFT, HOP_LENGTH, N_MELS
+import storage
+from config import SAMPLE_RATE, N_MFCC, N_FFT, HOP_LENGTH, N_MELS, VOICEPRINTS_NPZ
+
+
+# MFCC constants (depend only on config, so they are built once at import)
+
+# Periodic Hann window, mel filterbank and orthonormal DCT-II matrix, matching
+# the defaults of librosa.feature.mfcc
+_WINDOW = scipy.signal.get_window("hann", N_FFT, fftbins=True).astype(np.float32)
+_MEL_FB = librosa.filters.mel(sr=SAMPLE_RATE, n_fft=N_FFT, n_mels=N_MELS).astype(np.float32)
+_DCT = scipy.fft.dct(np.eye(N_MELS), type=2, norm="ortho", axis=0)[:N_MFCC].astype(np.float32)
 
 
 # Feature extraction
 
-def _apply_vad(y: np.ndarray, top_db_trim: float = 25.0, top_db_split: float = 30.0) -> np.ndarray:
+def _mfcc(y: np.ndarray, top_db: float = 80.0) -> np.ndarray:
+    """
+    Compute MFCCs of shape (N_MFCC, T) using the precomputed window,
+    mel filterbank and DCT matrix.
+
+    """
+    # Centered, windowed frames of shape (T, N_FFT), as librosa.stft builds them
+    y_padded = np.pad(y, N_FFT // 2, mode="constant")
+    frames = np.lib.stride_tricks.sliding_window_view(y_padded, N_FFT)[::HOP_LENGTH] * _WINDOW
+
+    # Power spectrogram; frames are independent so the FFTs run on all cores
+    spec = scipy.fft.rfft(frames, n=N_FFT, axis=-1, workers=-1)
+    S = np.abs(spec) ** 2
+
+    # Mel spectrogram in dB (same as librosa.power_to_db with ref=1.0)
+    mel = _MEL_FB @ S.T
+    log_mel = 10.0 * np.log10(np.maximum(mel, 1e-10))
+    log_mel = np.maximum(log_mel, log_mel.max() - top_db)
+
+    return _DCT @ log_mel
+
+
+def _apply_vad(
+    y: np.ndarray,
+    top_db_trim: float = 25.0,
+    top_db_split: float = 30.0,
+    frame_length: int = 2048,
+    hop_length: int = 512,
+) -> np.ndarray:
     """
     Apply voice activity detection (VAD) to remove silence
     and low-energy regions.
 
+    Same result as librosa.effects.trim followed by librosa.effects.split,
+    but the frame energies are computed once and the voiced samples are
+    gathered with a single boolean mask.
+
     """
+    # Per-frame RMS energy (centered frames) in dB relative to the loudest frame
+    y_padded = np.pad(y, frame_length // 2, mode="constant")
+    frames = np.lib.stride_tricks.sliding_window_view(y_padded, frame_length)[::hop_length]
+    rms = np.sqrt(np.einsum("ij,ij->i", frames, frames) / frame_length)
+    rms_db = 20.0 * np.log10(np.maximum(rms, 1e-5))
+    rms_db -= rms_db.max()
+
     # Trim leading/trailing silence
-    y_trimmed, _ = librosa.effects.trim(y, top_db=top_db_trim)
+    loud = np.flatnonzero(rms_db > -top_db_trim)
 
     # If everything got trimmed, fall back to original
-    if y_trimmed.size == 0:
-        y_trimmed = y
+    if loud.size == 0:
+        first, last = 0, rms_db.size - 1
+    else:
+        first, last = loud[0], loud[-1]
 
-    # Split into non-silent intervals
-    intervals = librosa.effects.split(y_trimmed, top_db=top_db_split)
+    # Keep non-silent frames inside the trimmed region
+    voiced_frames = rms_db > -top_db_split
+    voiced_frames[:first] = False
+    voiced_frames[last + 1:] = False
 
-    # If no intervals found, fall back to trimmed signal
-    if len(intervals) == 0:
-        return y_trimmed
+    # If no voiced frames found, fall back to trimmed signal
+    if not voiced_frames.any():
+        return y[first * hop_length:(last + 1) * hop_length]
 
-    # Concatenate non-silent segments
-    voiced = [y_trimmed[start:end] for start, end in intervals]
-    y_voiced = np.concatenate(voiced)
+    # Each frame owns the hop_length samples starting at its center
+    mask = np.repeat(voiced_frames, hop_length)[: y.size]
+    return y[mask]
 
-    # Safety: if something went wrong, fall back to trimmed signal
-    if y_voiced.size == 0:
-        return y_trimmed
 
-    return y_voiced
+def _load_audio(source: Union[str, BinaryIO]) -> np.ndarray:
+    """
+    Read a WAV file (path or file-like object) as a mono float32 signal at SAMPLE_RATE.
+
+    """
+    # Load audio as float32; the Pi already records 16 kHz mono so no resample is needed
+    y, sr = sf.read(source, dtype="float32", always_2d=False)
+
+    # Downmix to mono if the file unexpectedly has several channels
+    if y.ndim > 1:
+        y = y.mean(axis=1, dtype=np.float32)
+
+    # Only resample when the recording doesn't match SAMPLE_RATE
+    if sr != SAMPLE_RATE:
+        y = librosa.resample(y, orig_sr=sr, target_sr=SAMPLE_RATE)
+
+    return y
 
 
 def extract_features(filepath: str) -> np.ndarray:
@@ -67,9 +139,24 @@ def extract_features(filepath: str) -> np.ndarray:
     if not os.path.exists(filepath):
         raise FileNotFoundError(f"Audio file not found: {filepath}")
 
-    # Load audio as mono, resample to SAMPLE_RATE
-    y, sr = librosa.load(filepath, sr=SAMPLE_RATE, mono=True)
+    return _embed(_load_audio(filepath))
+
+
+def extract_features_from_bytes(raw: bytes) -> np.ndarray:
+    """
+    Same as extract_features, but for WAV data already held in memory
+    (e.g. an uploaded file), so it never has to touch the disk.
+
+    """
+    return _embed(_load_audio(io.BytesIO(raw)))
+
 
+def _embed(y: np.ndarray) -> np.ndarray:
+    """
+    Turn a mono signal at SAMPLE_RATE into the L2-normalized embedding
+    described in extract_features.
+
+    """
     if y.size == 0:
         raise ValueError("Empty audio signal.")
 
@@ -81,98 +168,126 @@ def extract_features(filepath: str) -> np.ndarray:
         raise ValueError("Less than 0.5s of voiced speech.")
 
     # Compute MFCCs on voiced signal
-    mfcc = librosa.feature.mfcc(
-        y=y_voiced,
-        sr=sr,
-        n_mfcc=N_MFCC,
-        n_fft=N_FFT,
-        hop_length=HOP_LENGTH,
-        n_mels=N_MELS,
-    )  
+    mfcc = _mfcc(y_voiced)
 
     # Drop c0 (row 0) and keep c1..c(N_MFCC-1)
     if mfcc.shape[0] < 2:
         raise ValueError("Not enough MFCC coefficients computed.")
     mfcc_no_c0 = mfcc[1:, :] 
 
-    # Compute statistics over time: mean and std for each coefficient
-    mfcc_mean = np.mean(mfcc_no_c0, axis=1)
-    mfcc_std = np.std(mfcc_no_c0, axis=1)
-
-    # Concatenate into a single feature vector
-    feature_vector = np.concatenate([mfcc_mean, mfcc_std], axis=0)  # dimension will be 2*(N_MFCC-1)
+    # Compute statistics over time: mean and std for each coefficient,
+    # written straight into a single feature vector of dimension 2*(N_MFCC-1)
+    n_coeffs = mfcc_no_c0.shape[0]
+    feature_vector = np.empty(2 * n_coeffs, dtype=np.float32)
+    np.mean(mfcc_no_c0, axis=1, dtype=np.float32, out=feature_vector[:n_coeffs])
+    np.std(mfcc_no_c0, axis=1, dtype=np.float32, out=feature_vector[n_coeffs:])
 
-    # L2-normalize to get an embedding suitable for cosine distance
+    # L2-normalize (in place) to get an embedding suitable for cosine distance
     norm = np.linalg.norm(feature_vector)
     if norm > 1e-10:
-        feature_vector = feature_vector / norm
+        feature_vector /= norm
 
     return feature_vector
 
 
 # Distance and predition   
 
-def _cosine_distance(a: np.ndarray, b: np.ndarray) -> float:
+# Dimensionality of the embedding produced by extract_features (mean + std of c1..c(N_MFCC-1))
+FEATURE_DIM = 2 * (N_MFCC - 1)
+
+
+def _normalize_rows(users: List[str], matrix: np.ndarray) -> Tuple[List[str], np.ndarray]:
     """
-    Compute cosine distance between two vectors:
-    distance = 1 - cosine_similarity.
+    L2-normalize every row of an (N, D) voiceprint matrix, dropping zero rows.
 
     """
-    dot = float(np.dot(a, b))
-    norm_a = float(np.linalg.norm(a))
-    norm_b = float(np.linalg.norm(b))
+    norms = np.linalg.norm(matrix, axis=1)
+    keep = norms > 1e-10
+    users = [u for u, k in zip(users, keep) if k]
 
-    if norm_a == 0.0 or norm_b == 0.0:
-        # Maximum distance if one vector is zero
-        return 2.0
+    # Kept in float32: int8 quantization shifts distances by up to ~0.005,
+    # which is half of DISTANCE_THRESHOLD
+    matrix = np.ascontiguousarray(matrix[keep] / norms[keep, np.newaxis], dtype=np.float32)
+    return users, matrix
 
-    cosine_sim = dot / (norm_a * norm_b)
-    return float(1.0 - cosine_sim)
 
+# Voiceprint matrix cache, rebuilt only when the voiceprints file changes on disk
+_VP_CACHE: Dict[str, Any] = {"mtime": None, "users": [], "matrix": None}
+_VP_CACHE_LOCK = threading.Lock()
 
-def predict_speaker(
-    voiceprints: Dict[str, np.ndarray],
+
+def invalidate_vp_cache() -> None:
+    """Force the next get_voiceprint_matrix() call to reload voiceprints from disk."""
+    with _VP_CACHE_LOCK:
+        _VP_CACHE["mtime"] = None
+        _VP_CACHE["users"] = []
+        _VP_CACHE["matrix"] = None
+
+
+def get_voiceprint_matrix() -> Tuple[List[str], np.ndarray]:
+    """
+    Return the cached (users, matrix) pair for the stored voiceprints.
+
+    The voiceprints file is only re-read and re-stacked when its mtime changes
+    (or after invalidate_vp_cache()), so repeated authentications skip
+    loading and stacking the voiceprints.
+    """
+    try:
+        mtime = os.stat(VOICEPRINTS_NPZ).st_mtime_ns
+    except OSError:
+        mtime = None
+
+    with _VP_CACHE_LOCK:
+        if _VP_CACHE["matrix"] is None or _VP_CACHE["mtime"] != mtime:
+            users, matrix = _normalize_rows(*storage.load_voiceprints_matrix(FEATURE_DIM))
+            _VP_CACHE["mtime"] = mtime
+            _VP_CACHE["users"] = users
+            _VP_CACHE["matrix"] = matrix
+        return _VP_CACHE["users"], _VP_CACHE["matrix"]
+
+
+def predict_speaker_fast(
+    users: List[str],
+    matrix: np.ndarray,
     sample_feature: np.ndarray,
 ) -> Tuple[Optional[str], Optional[float]]:
     """
-    Given stored voiceprints and a sample feature vector, find the closest speaker
-    using cosine distance.
+    Find the closest speaker against a prebuilt voiceprint matrix.
 
-    :param voiceprints: dict: username -> np.ndarray (voiceprint embedding)
+    :param users: usernames, aligned with the rows of matrix
+    :param matrix: np.ndarray of shape (N, D) with L2-normalized voiceprints
     :param sample_feature: np.ndarray of shape (D,)
-    :return: (best_user, distance) or (None, None) if voiceprints is empty
+    :return: (best_user, distance) or (None, None) if there is nothing to compare
     """
-    if not voiceprints:
+    if not users or sample_feature.shape != (matrix.shape[1],):
         return None, None
 
-    best_user: Optional[str] = None
-    best_distance: Optional[float] = None
-
     # Ensure sample is L2-normalized (just in case)
     sample_norm = np.linalg.norm(sample_feature)
-    if sample_norm > 1e-10:
-        sample_feature = sample_feature / sample_norm
-
-    for username, vp in voiceprints.items():
-        # Ensure same dimensionality
-        if vp.shape != sample_feature.shape:
-            # Skip mismatched dims (e.g. after changing feature extractor)
-            continue
+    if sample_norm <= 1e-10:
+        # Maximum distance if the sample is a zero vector
+        return users[0], 2.0
+    sample = np.asarray(sample_feature, dtype=np.float32) / np.float32(sample_norm)
 
-        # L2-normalize stored voiceprint as well (if not already)
-        vp_norm = np.linalg.norm(vp)
-        if vp_norm > 1e-10:
-            vp_normed = vp / vp_norm
-        else:
-            vp_normed = vp
+    # Cosine similarity against every voiceprint at once: distance = 1 - similarity
+    sims = matrix @ sample
+    idx = int(np.argmax(sims))
 
-        dist = _cosine_distance(sample_feature, vp_normed)
+    return users[idx], float(1.0 - sims[idx])
 
-        if best_distance is None or dist < best_distance:
-            best_distance = dist
-            best_user = username
 
-    if best_user is None:
-        return None, None
+def predict_speaker(
+    voiceprints: Dict[str, np.ndarray],
+    sample_feature: np.ndarray,
+) -> Tuple[Optional[str], Optional[float]]:
+    """
+    Given stored voiceprints and a sample feature vector, find the closest speaker
+    using cosine distance.
 
-    return best_user, best_distance
+    :param voiceprints: dict: username -> np.ndarray (voiceprint embedding)
+    :param sample_feature: np.ndarray of shape (D,)
+    :return: (best_user, distance) or (None, None) if voiceprints is empty
+    """
+    # Voiceprints of another dimensionality or with a zero norm are skipped
+    users, matrix = _normalize_rows(*storage.stack_voiceprints(voiceprints, FEATURE_DIM))
+    return predict_speaker_fast(users, matrix, sample_feature)
@@ -2,165 +2,403 @@
 """
 storage.py
 
-JSON-based storage utilities for Voice Vault.
+JSON-based storage utilities for Voice Vault (voiceprints are kept in .npz).
 -Manage users and their audio samples
+-Store per-user sample features (.npy)
 -Store and load voiceprints
 -Store last authentication result
 -Store authentication attempts log
 -Load secrets for the vault
 """
 
-import json
+import fcntl
+import io
 import os
-from typing import Dict, Any, List, Optional
+import tempfile
+import zipfile
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import quote
+from typing import Dict, Any, Iterator, List, Optional, Tuple
 
 import numpy as np
+import orjson
 
 from config import (
     DATA_DIR,
     AUDIO_DIR,
+    FEATURES_DIR,
     SECRETS_DIR,
     USERS_JSON,
+    VOICEPRINTS_NPZ,
     VOICEPRINTS_JSON,
     LAST_AUTH_JSON,
+    ATTEMPTS_LOG,
     ATTEMPTS_JSON,
     SECRETS_JSON,
+    STORAGE_LOCK,
 )
 
 
 
 # Helpers
 
-def _read_json(path: str, default: Any) -> Any:
-    if not os.path.exists(path):
+# Parsed JSON files shared between calls: path -> ((st_mtime_ns, st_size), value)
+_JSON_CACHE: Dict[str, Tuple[Tuple[int, int], Any]] = {}
+
+
+def _read_json(path: str, default: Any, cached: bool = True) -> Any:
+    """
+    Parse a JSON file, returning default if it is missing or invalid.
+
+    With cached=True the parsed object is reused until the file's mtime or
+    size changes, so repeated reads cost a single os.stat. That object is
+    shared between callers and must not be mutated; pass cached=False to
+    get a private copy.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
         return default
+
+    key = (st.st_mtime_ns, st.st_size)
+    if cached:
+        hit = _JSON_CACHE.get(path)
+        if hit is not None and hit[0] == key:
+            return hit[1]
+
     try:
-        with open(path, "r") as f:
-            return json.load(f)
-    except (json.JSONDecodeError, OSError):
+        data = orjson.loads(Path(path).read_bytes())
+    except (orjson.JSONDecodeError, OSError):
         return default
 
+    if cached:
+        _JSON_CACHE[path] = (key, data)
+    return data
+
+
+def _atomic_write(path: str, buf: bytes) -> None:
+    """
+    Write buf to path so readers only ever see the old or the new file:
+    write a temp file in the same directory, fsync it, then os.replace it.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(buf)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_file_atomic(path: str, data: bytes) -> None:
+    """Atomically write raw bytes (e.g. an archived WAV) to path."""
+    _atomic_write(path, data)
+
+
+@contextmanager
+def _storage_lock() -> Iterator[None]:
+    """
+    Hold an exclusive lock on STORAGE_LOCK for a read-modify-write of the
+    users/features/voiceprint files. flock works across gunicorn workers,
+    and across threads too since every call opens its own file description.
+    """
+    with open(STORAGE_LOCK, "a") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
 
-def _convert_to_native_types(obj: Any) -> Any:
+def _json_default(obj: Any) -> Any:
     """
-    Convert numpy types to native Python types for JSON serialization.
+    Fallback for numpy values orjson can't encode natively
+    (e.g. non-contiguous arrays or unusual dtypes).
     """
-    import numpy as np
-    
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.bool_):
+        return bool(obj)
     if isinstance(obj, np.integer):
         return int(obj)
-    elif isinstance(obj, np.floating):
+    if isinstance(obj, np.floating):
         return float(obj)
-    elif isinstance(obj, np.bool_):
-        return bool(obj)
-    elif isinstance(obj, np.ndarray):
-        return obj.tolist()
-    elif isinstance(obj, dict):
-        return {key: _convert_to_native_types(value) for key, value in obj.items()}
-    elif isinstance(obj, (list, tuple)):
-        return [_convert_to_native_types(item) for item in obj]
-    else:
-        return obj
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
 
 
 def _write_json(path: str, data: Any) -> None:
-    # Convert numpy types to native Python types before JSON serialization
-    data = _convert_to_native_types(data)
-    with open(path, "w") as f:
-        json.dump(data, f, indent=2)
+    # orjson serializes numpy arrays and scalars natively, only the
+    # values it rejects go through _json_default
+    buf = orjson.dumps(
+        data,
+        option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY,
+        default=_json_default,
+    )
+    _atomic_write(path, buf)
+
+    # The caller may keep modifying data, so re-parse on the next read
+    # rather than caching it
+    _JSON_CACHE.pop(path, None)
 
 
 # Users
 
 def load_users() -> Dict[str, Any]:
+    # Cached and shared: callers that modify users must use _load_users_for_update()
     return _read_json(USERS_JSON, default={})
 
 
+def _load_users_for_update() -> Dict[str, Any]:
+    return _read_json(USERS_JSON, default={}, cached=False)
+
+
 def save_users(users: Dict[str, Any]) -> None:
     _write_json(USERS_JSON, users)
 
 
 def create_user(username: str) -> None:
-    users = load_users()
-    # First ensure that the user entry does not exist already
-    if username not in users:
-        users[username] = {
-            "audio_samples": []
+    with _storage_lock():
+        users = _load_users_for_update()
+        # First ensure that the user entry does not exist already
+        if username not in users:
+            users[username] = {
+                "audio_samples": []
+            }
+            save_users(users)
+
+
+def register_sample(username: str, audio_path: str, features: Any) -> None:
+    """
+    Register a new enrollment sample for a user and fold it into the
+    user's voiceprint as a running mean.
+
+    The feature vector is appended to the user's .npy file; users.json
+    only records the audio path and the row index.
+
+    """
+    with _storage_lock():
+        users = _load_users_for_update()
+        if username not in users:
+            users[username] = {"audio_samples": []}
+        user = users[username]
+        _migrate_legacy_features(username, user)
+
+        feats = np.asarray(features, dtype=np.float32).reshape(-1)
+
+        stored = load_features(username)
+        if stored.shape[0] == 0:
+            stored = feats[np.newaxis, :]
+        elif stored.shape[1] == feats.shape[0]:
+            stored = np.vstack([stored, feats])
+        else:
+            raise ValueError(
+                f"Feature dimension {feats.shape[0]} does not match stored samples ({stored.shape[1]})."
+            )
+        _save_features(username, stored)
+
+        sample_entry = {
+            "path": audio_path,
+            "index": stored.shape[0] - 1,
         }
+        user["audio_samples"].append(sample_entry)
+
+        # The voiceprint should be the mean of every row before this one;
+        # sample_count records how many samples were averaged into it
+        voiceprints = load_voiceprints()
+        vp = voiceprints.get(username)
+        n = stored.shape[0] - 1
+        if n != user.get("sample_count") or vp is None or vp.shape != feats.shape:
+            # Unknown or inconsistent state (e.g. enrolled before sample_count
+            # existed, or an interrupted update): rebuild from all samples
+            save_users(users)
+            _recompute_voiceprint(username)
+            return
+
+        # Running mean: new = (old * n + x) / (n + 1), accumulated in float64
+        voiceprints[username] = (vp.astype(np.float64) * n + feats) / (n + 1)
+        user["sample_count"] = n + 1
         save_users(users)
+        save_voiceprints(voiceprints)
 
 
-def register_sample(username: str, audio_path: str, features: Any) -> None:
+# Sample features
+
+def _features_path(username: str) -> str:
+    # Quote the username so it always maps to a single, safe file name
+    return os.path.join(FEATURES_DIR, quote(username, safe="") + ".npy")
+
+
+def load_features(username: str) -> np.ndarray:
+    """
+    Return a user's (n_samples, D) float32 feature matrix
+    (with no rows if nothing is stored yet).
     """
-    Register a new enrollment sample for a user.
+    try:
+        return np.load(_features_path(username))
+    except (OSError, ValueError):
+        return np.empty((0, 0), dtype=np.float32)
+
+
+def _save_features(username: str, features: np.ndarray) -> None:
+    buf = io.BytesIO()
+    np.save(buf, np.ascontiguousarray(features, dtype=np.float32))
+    _atomic_write(_features_path(username), buf.getvalue())
 
+
+def _migrate_legacy_features(username: str, user: Dict[str, Any]) -> bool:
     """
-    users = load_users()
-    if username not in users:
-        users[username] = {"audio_samples": []}
+    Move feature lists still embedded in users.json (older format) into the
+    user's .npy file, replacing them with row indices. Samples whose
+    features are malformed or of a different dimension are dropped from
+    the matrix. Returns True if the user entry was changed.
+    """
+    samples = user.get("audio_samples", [])
+    legacy = [s for s in samples if "features" in s]
+    if not legacy:
+        return False
+
+    # A fully legacy user is rebuilt from users.json alone, so a rerun after a
+    # crash (or another worker migrating at the same time) can't duplicate rows
+    rows: List[np.ndarray] = []
+    dim = None
+    if len(legacy) < len(samples):
+        stored = load_features(username)
+        rows = list(stored)
+        dim = stored.shape[1] if stored.shape[0] else None
+    for sample in legacy:
+        try:
+            feats = np.asarray(sample.pop("features"), dtype=np.float32).reshape(-1)
+        except (TypeError, ValueError):
+            continue
+        if dim is None:
+            dim = feats.shape[0]
+        if feats.shape[0] != dim:
+            continue
+        sample["index"] = len(rows)
+        rows.append(feats)
 
-    # Convert features to list (JSON serializable)
-    if isinstance(features, np.ndarray):
-        feat_list = features.tolist()
-    else:
-        feat_list = list(features)
+    if rows:
+        _save_features(username, np.stack(rows, axis=0))
+    return True
 
-    sample_entry = {
-        "path": audio_path,
-        "features": feat_list,
-    }
-    users[username]["audio_samples"].append(sample_entry)
-    save_users(users)
+
+def migrate_legacy_users() -> None:
+    """
+    Move every feature list still embedded in users.json into the per-user
+    .npy files, so load_users() never has to parse feature data.
+    """
+    with _storage_lock():
+        users = _load_users_for_update()
+        changed = False
+        for username, user in users.items():
+            changed |= _migrate_legacy_features(username, user)
+        if changed:
+            save_users(users)
 
 
 # Voiceprints
 
 def load_voiceprints() -> Dict[str, np.ndarray]:
+    """
+    Load voiceprints from voiceprints.npz, falling back to the legacy
+    voiceprints.json if no .npz has been written yet.
+    """
+    if os.path.exists(VOICEPRINTS_NPZ):
+        try:
+            with np.load(VOICEPRINTS_NPZ) as z:
+                usernames = z["usernames"].tolist()
+                return {u: z[f"arr_{i}"] for i, u in enumerate(usernames)}
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return {}
+
     raw = _read_json(VOICEPRINTS_JSON, default={})
     vp: Dict[str, np.ndarray] = {}
     for username, vec in raw.items():
         try:
-            vp[username] = np.array(vec, dtype=float)
+            vp[username] = np.array(vec, dtype=np.float32)
         except Exception:
             continue
     return vp
 
 
-def save_voiceprints(voiceprints: Dict[str, np.ndarray]) -> None:
+def stack_voiceprints(
+    voiceprints: Dict[str, np.ndarray], dim: Optional[int] = None
+) -> Tuple[List[str], np.ndarray]:
+    """
+    Stack voiceprints into a (usernames, matrix) pair, where matrix is a
+    contiguous (n_users, D) float32 array and matrix[i] belongs to
+    usernames[i]. Voiceprints whose length differs from dim (by default
+    the first voiceprint's length) are skipped.
+    """
+    if dim is None and voiceprints:
+        dim = next(iter(voiceprints.values())).shape[-1]
+
+    usernames = [u for u, v in voiceprints.items() if v.shape == (dim,)]
+    if not usernames:
+        return [], np.empty((0, dim or 0), dtype=np.float32)
 
-    raw = {u: v.tolist() for u, v in voiceprints.items()}
-    _write_json(VOICEPRINTS_JSON, raw)
+    matrix = np.stack([voiceprints[u] for u in usernames], axis=0).astype(np.float32)
+    return usernames, matrix
+
+
+def load_voiceprints_matrix(dim: Optional[int] = None) -> Tuple[List[str], np.ndarray]:
+    """Load the stored voiceprints stacked as by stack_voiceprints()."""
+    return stack_voiceprints(load_voiceprints(), dim)
+
+
+def save_voiceprints(voiceprints: Dict[str, np.ndarray]) -> None:
+    # Vectors are stored positionally (arr_0, arr_1, ...) with a parallel
+    # usernames array, so any username is safe to use
+    usernames = np.array(list(voiceprints.keys()), dtype=str)
+    vectors = [np.asarray(v, dtype=np.float32) for v in voiceprints.values()]
+    buf = io.BytesIO()
+    np.savez(buf, *vectors, usernames=usernames)
+    _atomic_write(VOICEPRINTS_NPZ, buf.getvalue())
 
 
 def recompute_voiceprint(username: str) -> None:
+    """
+    Rebuild a user's voiceprint from all of their samples. register_sample
+    keeps voiceprints up to date incrementally; this is the repair path.
+
+    """
+    with _storage_lock():
+        _recompute_voiceprint(username)
+
+
+def _recompute_voiceprint(username: str) -> None:
+    # Caller holds _storage_lock()
     # First ensure that the user entry exists
-    users = load_users()
+    users = _load_users_for_update()
     if username not in users:
         return
+    user = users[username]
+    migrated = _migrate_legacy_features(username, user)
 
-    samples = users[username].get("audio_samples", [])
-    if not samples:
+    features = load_features(username)
+    if features.shape[0] == 0:
+        if migrated:
+            save_users(users)
         return
 
-    feature_list = []
-    for s in samples:
-        feats = s.get("features")
-        if feats is not None:
-            try:
-                feature_list.append(np.array(feats, dtype=float))
-            except Exception:
-                continue
-
-    if not feature_list:
-        return
-
-    # Stack and get mean along axis 0
-    stacked = np.stack(feature_list, axis=0)  
-    centroid = np.mean(stacked, axis=0)
+    # Mean along axis 0 of the (n_samples, D) matrix, accumulated in float64
+    centroid = features.mean(axis=0, dtype=np.float64).astype(np.float32)
     voiceprints = load_voiceprints()
     voiceprints[username] = centroid
     save_voiceprints(voiceprints)
 
+    user["sample_count"] = features.shape[0]
+    save_users(users)
+
 
 # Last auth result
 
@@ -175,11 +413,34 @@ def save_last_auth_result(result: Dict[str, Any]) -> None:
 # Attempts log
 
 def load_attempts() -> List[Dict[str, Any]]:
-    return _read_json(ATTEMPTS_JSON, default=[])
+    """
+    Load the full attempts history: the legacy attempts.json (if any)
+    followed by every line of attempts.jsonl.
+    """
+    attempts = _read_json(ATTEMPTS_JSON, default=[], cached=False)
+    try:
+        with open(ATTEMPTS_LOG, "rb") as f:
+            for line in f:
+                try:
+                    attempts.append(orjson.loads(line))
+                except orjson.JSONDecodeError:
+                    # Skip a partially written line
+                    continue
+    except OSError:
+        pass
+    return attempts
 
 
 def save_attempts(attempts: List[Dict[str, Any]]) -> None:
-    _write_json(ATTEMPTS_JSON, attempts)
+    buf = b"".join(
+        orjson.dumps(a, option=orjson.OPT_SERIALIZE_NUMPY, default=_json_default) + b"\n"
+        for a in attempts
+    )
+    _atomic_write(ATTEMPTS_LOG, buf)
+
+    # The full history now lives in attempts.jsonl, drop the legacy copy
+    if os.path.exists(ATTEMPTS_JSON):
+        os.remove(ATTEMPTS_JSON)
 
 
 def log_attempt(
@@ -189,17 +450,20 @@ def log_attempt(
     success: bool,
     audio_path: str,
 ) -> None:
-    attempts = load_attempts()
-    attempts.append(
+    # Append a single JSON line instead of rewriting the whole history
+    line = orjson.dumps(
         {
             "timestamp": timestamp,
             "recognized_user": recognized_user,
             "distance": distance,
             "success": success,
             "audio_path": audio_path,
-        }
+        },
+        option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE,
+        default=_json_default,
     )
-    save_attempts(attempts)
+    with open(ATTEMPTS_LOG, "ab") as f:
+        f.write(line)
 
 
 # Secrets